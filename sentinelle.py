@@ -8,23 +8,133 @@ import hashlib
 import logging
 
 from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from csv import writer
 from datetime import datetime
-from os import scandir, cpu_count
-from os.path import getsize
+from mmap import mmap, ACCESS_READ
+from os import scandir, cpu_count, fstat
 from pathlib import Path
-from re import compile
+from queue import Queue
+from shutil import which
+from stat import S_ISREG
+from subprocess import run
 from sys import stdout
+from tempfile import TemporaryFile
+from threading import Lock, Thread, local
 from unicodedata import normalize
 
+try:
+    from blake3 import blake3
+except ImportError:  # bibliothèque optionnelle, repli sur hashlib
+    blake3 = None
+
+try:
+    from xxhash import xxh3_64_intdigest as hash_rapide
+except ImportError:  # bibliothèque optionnelle, repli sur zlib
+    from zlib import crc32 as hash_rapide
+
+# binaire optionnel : s'il est présent, il calcule seul tous les hash complets
+B3SUM = which("b3sum")
+
 LONGUEUR_MAXIMALE_FICHIER = 255
-REGEX_DOSSIER_VIDE = compile(r"^[\w ]+-VIDE$")
-REGEX_NIVEAU_1 = compile(r"^[0-9]{2}_[A-Z]{3}_[\w\s-]+$")
-REGEX_NIVEAU_2 = compile(r"^(Z_)?[0-9]{6}_[A-Z]+_\d+_[\w\s-]+$")
+TAILLE_MAX_MMAP = 128 * 1024 * 1024  # au-delà, lecture par blocs pour borner la mémoire
+TAILLE_BLOC = 1024 * 1024
+TAILLE_ENTETE = 4096
+# en dessous, le lancement des processus coûte plus qu'il ne rapporte
+SEUIL_PROCESSUS = 1000
+# ProcessPoolExecutor refuse plus de 61 processus sous Windows
+MAX_PROCESSUS = 61
+# le scan attend surtout le serveur de fichiers (SMB) : plus de threads que de coeurs
+NB_THREADS_SCAN = 16
+LOT_B3SUM = 256  # nombre de fichiers par appel à b3sum
+LONGUEUR_MAX_COMMANDE = 30000  # la ligne de commande Windows est limitée à 32767
+CARACTERES_SPECIAUX_CSV = ';"\r\n'  # imposent des guillemets autour de la cellule
+MARQUE_VIDE = "-VIDE"
 # REGEX_NIVEAU_3 = compile(r"^([A-Z])\w+$")
 
 
+# tampon de lecture de chaque thread, réutilisé d'un fichier à l'autre
+_tampons = local()
+
+
+def _tampon() -> memoryview:
+    """Retourne le tampon de lecture du thread courant (créé au 1er appel)."""
+    tampon = getattr(_tampons, "tampon", None)
+    if tampon is None:
+        tampon = _tampons.tampon = memoryview(bytearray(TAILLE_BLOC))
+    return tampon
+
+
+# fonctions de hash au niveau du module : sérialisables telles quelles vers les
+# processus de calcul, sans avoir à transmettre la classe
+def hash_file(chemin: str, taille: int):
+    """Retourne (hash, path) ou (None, path) si erreur, `taille` étant celle
+    relevée lors du scan."""
+    try:
+        if blake3 is not None:
+            # les gros fichiers sont aussi découpés entre plusieurs threads par blake3
+            gros = taille > TAILLE_MAX_MMAP
+            hasher = blake3(max_threads=blake3.AUTO if gros else 1)
+            hasher.update_mmap(chemin)
+            return hasher.digest(length=32), chemin
+        hasher = hashlib.blake2b(digest_size=32)
+        with open(chemin, "rb", buffering=0) as f:
+            taille = fstat(f.fileno()).st_size
+            # mmap refuse les fichiers vides
+            if 0 < taille <= TAILLE_MAX_MMAP:
+                with mmap(f.fileno(), 0, access=ACCESS_READ) as mm:
+                    hasher.update(mm)
+            else:
+                mv = _tampon()
+                n = f.readinto(mv)
+                while n:
+                    hasher.update(mv[:n])
+                    n = f.readinto(mv)
+        return hasher.digest(), chemin
+    except Exception as e:
+        logging.debug(e)
+        return None, chemin
+
+
+def head_hash(chemin: str, taille: int):
+    """Retourne (hash rapide des premiers octets, path) ou (None, path) si erreur,
+    `taille` n'étant pas utilisée (signature commune avec hash_file)."""
+    try:
+        with open(chemin, "rb", buffering=0) as f:
+            return hash_rapide(f.read(TAILLE_ENTETE)), chemin
+    except Exception as e:
+        logging.debug(e)
+        return None, chemin
+
+
+def hash_files_b3sum(chemins: list) -> list:
+    """Retourne les (hash, path) d'un lot de fichiers calculés par b3sum,
+    (None, path) pour les fichiers illisibles."""
+    try:
+        # un seul thread par appel : les lots tournent déjà en parallèle
+        sortie = run(
+            [B3SUM, "--no-names", "--num-threads", "1", "--", *chemins],
+            capture_output=True,
+        )
+    except OSError as e:
+        logging.debug(e)
+        sortie = None
+    if sortie is not None and sortie.returncode == 0:
+        hashs = sortie.stdout.decode("ascii", errors="replace").split()
+        if len(hashs) == len(chemins):
+            try:
+                # même forme que hash_file : l'empreinte brute, deux fois plus compacte
+                return [(bytes.fromhex(h), c) for h, c in zip(hashs, chemins)]
+            except ValueError as e:
+                logging.debug(e)
+    if len(chemins) == 1:
+        if sortie is not None:
+            logging.debug(sortie.stderr.decode("utf-8", errors="replace").strip())
+        return [(None, chemins[0])]
+    # un fichier illisible fait échouer tout le lot : chaque fichier est repris seul
+    return [resultat for chemin in chemins for resultat in hash_files_b3sum([chemin])]
+
+
 class SentinelleErreur(Exception):
     pass
 
@@ -33,18 +143,23 @@ class Sentinelle:
     def __init__(self, chemin_in: Path, chemin_out: Path, profondeur_max: int) -> None:
         """Initialisation de l'objet"""
         self._chemin_in = chemin_in
-        self._niveau_chemin_in = len(chemin_in.parents)
         self._chemin_out = chemin_out
         self._profondeur_max = profondeur_max
         # vérification des chemins
         self._verifie_chemins()
         # variables
         self._now = datetime.now()
+        self._str_date = self._now.strftime("%Y-%m-%d %H%M%S")
+        self._str_nom = chemin_in.stem
+        # chemins des rapports, normalisés (NFC) dès leur ajout
         self._trop_long = []
         self._mauvais_nom = []
         self._vide = []
         self._non_vide = []
-        self._hash_map = defaultdict(list)
+        self._tailles = defaultdict(list)
+        self._verrou = Lock()  # fusion des tailles des scans parallèles
+        self._taille_hash = {}  # taille (octets) connue depuis le scan, par doublon
+        # empreinte brute (bytes) -> chemins, uniquement pour les doublons
         self._dupliques = {}
 
     def _verifie_chemins(self) -> None:
@@ -65,220 +180,436 @@ class Sentinelle:
                 )
                 raise SentinelleErreur()
         else:
-            # test des droits d'écriture
+            # test des droits d'écriture par un vrai fichier : sous Windows,
+            # os.access ignore les ACL et les droits du partage réseau. Un
+            # fichier temporaire au nom unique n'écrase aucun fichier existant
             try:
-                (self._chemin_out / "test").touch()
-            except PermissionError:
+                with TemporaryFile(dir=self._chemin_out):
+                    pass
+            except OSError:
                 logging.critical(
                     "le programme n'a pas les droits d'écriture sur le chemin de sortie"
                 )
                 raise SentinelleErreur()
-            else:
-                (self._chemin_out / "test").unlink()
 
     @staticmethod
-    def _hash_file(chemin: str):
-        """Retourne (hash, path) ou (None, path) si erreur."""
-        try:
-            hasher = hashlib.blake2b(digest_size=32)
-            with open(chemin, "rb") as f:
-                chunk = f.read(8192)
-                while chunk:
-                    hasher.update(chunk)
-                    chunk = f.read(8192)
-            return hasher.hexdigest(), chemin
-        except Exception as e:
-            logging.debug(e)
-            return None, chemin
-
-    def _verif_fichier_longueur(self, fichier: str):
-        """vérifie que le fichier n'a pas un chemin trop long"""
-        if len(fichier) > LONGUEUR_MAXIMALE_FICHIER:
-            self._trop_long.append(fichier)
-
-    def _verif_dossier_nom(self, dossier: Path):
+    def _suffixe_valide(suffixe: str) -> bool:
+        r"""équivalent de [\w\s-]+ : lettres, chiffres, espaces, "_" ou "-" """
+        reste = "".join(suffixe.split()).replace("_", "").replace("-", "")
+        return bool(suffixe) and (not reste or reste.isalnum())
+
+    @staticmethod
+    def _match_vide(nom: str) -> bool:
+        r"""équivalent sans regex de ^[\w ]+-VIDE$"""
+        prefixe = nom[: -len(MARQUE_VIDE)]
+        reste = prefixe.replace(" ", "").replace("_", "")
+        return (
+            nom.endswith(MARQUE_VIDE)
+            and bool(prefixe)
+            and (not reste or reste.isalnum())
+        )
+
+    @classmethod
+    def _match_niveau_1(cls, nom: str) -> bool:
+        r"""équivalent sans regex de ^[0-9]{2}_[A-Z]{3}_[\w\s-]+$"""
+        chiffres, lettres = nom[:2], nom[3:6]
+        return (
+            len(nom) > 7
+            and nom[2] == "_"
+            and nom[6] == "_"
+            and chiffres.isascii()
+            and chiffres.isdigit()
+            and lettres.isascii()
+            and lettres.isalpha()
+            and lettres.isupper()
+            and cls._suffixe_valide(nom[7:])
+        )
+
+    @classmethod
+    def _match_niveau_2(cls, nom: str) -> bool:
+        r"""équivalent sans regex de ^(Z_)?[0-9]{6}_[A-Z]+_\d+_[\w\s-]+$"""
+        debut = 2 if nom.startswith("Z_") else 0
+        chiffres = nom[debut : debut + 6]
+        if not (
+            len(chiffres) == 6
+            and chiffres.isascii()
+            and chiffres.isdigit()
+            and nom[debut + 6 : debut + 7] == "_"
+        ):
+            return False
+        # ni [A-Z] ni \d ne contiennent "_" : le découpage est sans ambiguïté
+        morceaux = nom[debut + 7 :].split("_", 2)
+        if len(morceaux) != 3:
+            return False
+        lettres, nombre, suffixe = morceaux
+        return (
+            lettres.isascii()
+            and lettres.isalpha()
+            and lettres.isupper()
+            and nombre.isdecimal()
+            and cls._suffixe_valide(suffixe)
+        )
+
+    def _verif_dossier_nom(self, dossier: str, nom: str, niveau: int):
         """vérifie que le nom d'un dossier est cohérent"""
-        niveau = len(dossier.parents) - self._niveau_chemin_in
         if niveau == 1:  # cf note ARBOMUT chap. 4.2
-            if not REGEX_NIVEAU_1.match(dossier.name):
-                self._mauvais_nom.append((niveau, str(dossier)))
+            if not self._match_niveau_1(nom):
+                self._mauvais_nom.append((niveau, normalize("NFC", dossier)))
         elif niveau == 2:  # cf note ARBOMUT chap. 4.3
-            if not REGEX_NIVEAU_2.match(dossier.name):
-                self._mauvais_nom.append((niveau, str(dossier)))
-            if len(dossier.name) > 50:
-                self._trop_long.append(str(dossier))
+            if not self._match_niveau_2(nom):
+                self._mauvais_nom.append((niveau, normalize("NFC", dossier)))
+            if len(nom) > 50:
+                self._trop_long.append(normalize("NFC", dossier))
         # elif niveau == 3:
-        #    if not REGEX_NIVEAU_3.match(dossier.name):
-        #        self._mauvais_nom.append((niveau, str(dossier)))
+        #    if not REGEX_NIVEAU_3.match(nom):
+        #        self._mauvais_nom.append((niveau, normalize("NFC", dossier)))
 
     @staticmethod
-    def _is_dossier_non_vide(dossier: Path):
+    def _is_dossier_non_vide(dossier: str):
         """vérifie qu'un dossier est vide tout élément"""
         try:
-            for _ in scandir(dossier):
-                return True
+            # arrêt dès la 1ère entrée, le handle du dossier est fermé aussitôt
+            with scandir(dossier) as entries:
+                return next(entries, None) is not None
         except PermissionError:
             pass
         except FileNotFoundError:
             pass  # bug: si le chemin est trop long, le fichier n'est pas lisible
         return False  # Aucun fichier ou dossier trouvé dans ce dossier ni ses sous-dossiers
 
-    def _verif_dossier_vide(self, dossier: Path):
+    def _verif_dossier_vide(self, dossier: str, nom: str, non_vide: bool):
         """vérifie qu'un dossier se prétendant vide l'est bien (et inversement)"""
-        if REGEX_DOSSIER_VIDE.match(str(dossier.name)):
-            if self._is_dossier_non_vide(dossier):
-                self._vide.append(str(dossier))
+        if self._match_vide(nom):
+            if non_vide:
+                self._vide.append(normalize("NFC", dossier))
         else:
-            if not self._is_dossier_non_vide(dossier):
-                self._non_vide.append(str(dossier))
+            if not non_vide:
+                self._non_vide.append(normalize("NFC", dossier))
 
-    def _scanne(self, chemin_racine: Path):
-        stack = [chemin_racine]
-        # plusieurs threads pour le calculs des hash
-        with ThreadPoolExecutor(max_workers=cpu_count() or 4) as executor:
-            futures = []
-            # tant qu'il reste des dossiers à scanner
-            while stack:
-                current = stack.pop()
+    def _scanne_dossier(
+        self, current: str, nom_current, niveau_current: int, empile, tailles
+    ):
+        """scanne un dossier : vérifie ses entrées, transmet ses sous-dossiers à
+        `empile` et range ses fichiers par taille dans `tailles`"""
+        if niveau_current == 1:
+            logging.info("%s", current)
+        niveau = niveau_current + 1  # niveau de ses sous-dossiers
+        profondeur_max = self._profondeur_max
+        # méthodes et conteneurs résolus une fois pour toute la boucle
+        verif_nom, verif_vide = self._verif_dossier_nom, self._verif_dossier_vide
+        trop_long_append = self._trop_long.append
+        non_vide = False
+        try:
+            # scanne le dossier
+            for entry in scandir(current):
+                non_vide = True
+                p = entry.path
+                # si le scanné est un dossier, on l'ajoute à la file des dossiers à scanner
+                if entry.is_dir(follow_symlinks=False):
+                    nom = entry.name
+                    # vérifie que le dossier n'est pas trop profond
+                    if niveau <= profondeur_max:
+                        # son vide sera vérifié lors de son propre scan
+                        empile((p, nom, niveau))
+                    else:
+                        verif_vide(p, nom, self._is_dossier_non_vide(p))
+                    # vérification du regex
+                    verif_nom(p, nom, niveau)
+
+                # sinon un seul stat (en cache sous Windows) donne à la fois
+                # le type et la taille
+                else:
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    # si le scanné est un fichier, on procède aux vérifications
+                    if not S_ISREG(stat.st_mode):
+                        continue
+                    # vérification du chemin UNC
+                    if len(p) > LONGUEUR_MAXIMALE_FICHIER:
+                        trop_long_append(normalize("NFC", p))
+                    # regroupement par taille, seuls les fichiers de même taille
+                    # peuvent être des doublons
+                    tailles[stat.st_size].append(p)
+
+        except PermissionError:
+            pass
+        except FileNotFoundError:
+            pass  # bug: si le chemin est trop long, le fichier n'est pas lisible
+
+        # vérifie s'il est vide, sans le rescanner
+        if nom_current is not None:
+            verif_vide(current, nom_current, non_vide)
+
+    def _scanne(self, dossiers: list):
+        """scanne les dossiers de 1er niveau et toute leur arborescence, avec
+        plusieurs threads qui se partagent une file de dossiers à scanner"""
+        # (chemin, nom, niveau) : le nom sert à la vérification du vide une fois le
+        # dossier scanné, le niveau de ses enfants se déduit du sien
+        file = Queue()
+        for dossier in dossiers:
+            file.put((dossier, None, 1))
+        erreurs = []
+
+        def arpenteur():
+            # tailles propres à ce thread, fusionnées sous verrou à la fin (les listes
+            # des rapports, elles, ne reçoivent que des list.append qui sont atomiques)
+            tailles = defaultdict(list)
+            while True:
+                tache = file.get()
+                if tache is None:  # sentinelle de fin
+                    break
                 try:
-                    # scanne le dossier
-                    for entry in scandir(current):
-                        entry_path = Path(entry.path)
-
-                        # si le scanné est un dossier, on l'ajoute à la pile des dossiers à scanner
-                        if entry.is_dir(follow_symlinks=False):
-                            # vérifie que le dossier n'est pas trop profond
-                            if (
-                                len(entry_path.parents) - self._niveau_chemin_in
-                                <= self._profondeur_max
-                            ):
-                                stack.append(entry.path)
-                            # vérification du regex
-                            self._verif_dossier_nom(entry_path)
-                            # vérifie s'il est vide
-                            self._verif_dossier_vide(entry_path)
-
-                        # si le scanné est un fichier, on procède aux vérifications
-                        elif entry.is_file(follow_symlinks=False):
-                            # vérification du chemin UNC
-                            self._verif_fichier_longueur(
-                                entry.path
-                            )  # besoin d'un 'str'
-                            # lance le calcul du hash
-                            futures.append(executor.submit(self._hash_file, entry.path))
-
-                except PermissionError:
-                    continue
-                except FileNotFoundError:
-                    pass  # bug: si le chemin est trop long, le fichier n'est pas lisible
-
-        # Détermination des doublons (attente de tous les hachages si besoin)
-        for future in as_completed(futures):
-            hash_result, path = future.result()
-            if hash_result:
-                self._hash_map[hash_result].append(path)
-        self._dupliques.update(
-            {h: paths for h, paths in self._hash_map.items() if len(paths) > 1}
+                    self._scanne_dossier(*tache, file.put, tailles)
+                except Exception as e:
+                    erreurs.append(e)
+                finally:
+                    file.task_done()
+            with self._verrou:
+                for taille, chemins in tailles.items():
+                    self._tailles[taille].extend(chemins)
+
+        threads = [
+            Thread(target=arpenteur, daemon=True) for _ in range(NB_THREADS_SCAN)
+        ]
+        for thread in threads:
+            thread.start()
+        # tous les dossiers, y compris ceux ajoutés en cours de route, sont scannés
+        file.join()
+        for _ in threads:
+            file.put(None)
+        for thread in threads:
+            thread.join()
+        # remonte les éventuelles erreurs des scans
+        if erreurs:
+            raise erreurs[0]
+
+    @staticmethod
+    def _hache_en_parallele(fonction, taches):
+        """applique `fonction(chemin, taille)` aux couples (taille, chemin) de `taches`
+        dans des threads alimentés par une file bornée (ou des processus si les
+        fichiers sont nombreux), retourne la liste des (taille, hash, chemin)"""
+        taches = list(taches)
+        if len(taches) > SEUIL_PROCESSUS:
+            # chaque processus a son propre interpréteur, les hash tournent vraiment
+            # en parallèle (pas de GIL partagé)
+            nb_processus = min(cpu_count() or 4, MAX_PROCESSUS)
+            # ~4 lots par processus, comme multiprocessing.Pool.map : le coût des
+            # échanges est amorti sur des centaines de fichiers par aller-retour
+            taille_lot = max(1, len(taches) // (4 * nb_processus))
+            with ProcessPoolExecutor(max_workers=nb_processus) as executor:
+                return [
+                    (taille, hash_result, chemin)
+                    for (taille, _), (hash_result, chemin) in zip(
+                        taches,
+                        executor.map(
+                            fonction,
+                            [chemin for _, chemin in taches],
+                            [taille for taille, _ in taches],
+                            chunksize=taille_lot,
+                        ),
+                    )
+                    if hash_result is not None
+                ]
+
+        nb_threads = cpu_count() or 4
+        file = Queue(maxsize=4 * nb_threads)
+        resultats = []
+
+        def travailleur():
+            while True:
+                tache = file.get()
+                if tache is None:  # sentinelle de fin
+                    return
+                taille, chemin = tache
+                hash_result, _ = fonction(chemin, taille)
+                if hash_result is not None:
+                    resultats.append((taille, hash_result, chemin))
+
+        threads = [Thread(target=travailleur, daemon=True) for _ in range(nb_threads)]
+        for thread in threads:
+            thread.start()
+        for tache in taches:
+            file.put(tache)
+        for _ in threads:
+            file.put(None)
+        for thread in threads:
+            thread.join()
+        return resultats
+
+    @staticmethod
+    def _hache_avec_b3sum(taches):
+        """calcule avec b3sum les hash des couples (clé, chemin) de `taches`, par lots
+        lancés en parallèle, retourne la liste des (clé, hash, chemin)"""
+        lots, lot, longueur = [], [], 0
+        for tache in taches:
+            if lot and (
+                len(lot) == LOT_B3SUM
+                or longueur + len(tache[1]) > LONGUEUR_MAX_COMMANDE
+            ):
+                lots.append(lot)
+                lot, longueur = [], 0
+            lot.append(tache)
+            longueur += len(tache[1]) + 1
+        if lot:
+            lots.append(lot)
+
+        with ThreadPoolExecutor(max_workers=cpu_count() or 4) as executor:
+            resultats = executor.map(
+                hash_files_b3sum, ([chemin for _, chemin in lot] for lot in lots)
+            )
+            return [
+                (cle, hash_result, chemin)
+                for lot, hashs in zip(lots, resultats)
+                for (cle, _), (hash_result, chemin) in zip(lot, hashs)
+                if hash_result is not None
+            ]
+
+    def _cherche_doublons(self):
+        """calcule le hash des fichiers de même taille pour trouver les doublons"""
+        # les petits fichiers seraient lus en entier par le tri sur leur début : ils
+        # passent directement au hash complet
+        candidats = defaultdict(list)
+        for taille, chemins in self._tailles.items():
+            if len(chemins) > 1 and taille <= TAILLE_ENTETE:
+                candidats[(taille, None)] = chemins
+
+        # 1er tri peu coûteux sur le début des gros fichiers de même taille
+        for taille, head_result, path in self._hache_en_parallele(
+            head_hash,
+            (
+                (taille, chemin)
+                for taille, chemins in self._tailles.items()
+                if len(chemins) > 1 and taille > TAILLE_ENTETE
+                for chemin in chemins
+            ),
+        ):
+            candidats[(taille, head_result)].append(path)
+
+        # hash complet des fichiers dont la taille et le début coïncident
+        taches = (
+            (taille, chemin)
+            for (taille, _), chemins in candidats.items()
+            if len(chemins) > 1
+            for chemin in chemins
+        )
+        if B3SUM is not None:
+            resultats = self._hache_avec_b3sum(taches)
+        else:
+            resultats = self._hache_en_parallele(hash_file, taches)
+        premiers = {}  # hash -> 1er chemin rencontré, libéré en fin de recherche
+        for taille, hash_result, path in resultats:
+            # seules les collisions sont conservées sous forme de liste
+            premier = premiers.setdefault(hash_result, path)
+            if premier is path:
+                continue
+            chemins = self._dupliques.get(hash_result)
+            if chemins is None:
+                self._dupliques[hash_result] = [premier, path]
+                self._taille_hash[hash_result] = taille
+            else:
+                chemins.append(path)
+
+    @staticmethod
+    def _echappe_csv(valeurs: list) -> list:
+        """met entre guillemets les cellules qui l'exigent, comme csv.writer"""
+        # un seul test sur l'ensemble : le cas courant ne contient aucun caractère spécial
+        brut = "".join(valeurs)
+        if not any(c in brut for c in CARACTERES_SPECIAUX_CSV):
+            return valeurs
+        return [
+            (
+                '"' + v.replace('"', '""') + '"'
+                if any(c in v for c in CARACTERES_SPECIAUX_CSV)
+                else v
+            )
+            for v in valeurs
+        ]
+
+    def _ouvre_csv(self, nom: str):
+        """ouvre en écriture le fichier CSV d'un rapport, avec un tampon de 1 Mo"""
+        return open(
+            self._chemin_out / f"{self._str_nom} {self._str_date} {nom}.csv",
+            "w",
+            newline="",
+            encoding="cp1252",
+            buffering=1 << 20,
+        )
+
+    def _trie_resultats(self):
+        """trie les résultats, que les scans et hachages parallèles produisent
+        dans un ordre variable"""
+        self._mauvais_nom.sort()
+        self._vide.sort()
+        self._non_vide.sort()
+        self._trop_long.sort()
+        for paths in self._dupliques.values():
+            paths.sort()
+        # les groupes de doublons sont classés par leur premier chemin
+        self._dupliques = dict(
+            sorted(self._dupliques.items(), key=lambda item: item[1][0])
         )
 
     def _exporte_csv(self):
         """exporte les résultats dans des fichiers CSV"""
         # Export dossiers avec noms invalides
-        str_date = self._now.strftime("%Y-%m-%d %H%M%S")
-        str_nom = self._chemin_in.stem
         if self._mauvais_nom:
-            with open(
-                self._chemin_out
-                / f"{str_nom} {str_date} {str_nom} dossiers mal nommés.csv",
-                "w",
-                newline="",
-                encoding="cp1252",
-            ) as f:
-                w = writer(f, delimiter=";")
-                w.writerow(["niveau", "chemin"])
-                for niv, path in self._mauvais_nom:
-                    path_norm = normalize("NFC", str(path))
-                    w.writerow([niv, path_norm])
+            with self._ouvre_csv("dossiers mal nommés") as f:
+                chemins = self._echappe_csv([path for _, path in self._mauvais_nom])
+                f.write("niveau;chemin\r\n")
+                f.write(
+                    "".join(
+                        f"{niv};{path}\r\n"
+                        for (niv, _), path in zip(self._mauvais_nom, chemins)
+                    )
+                )
 
         # Export dossiers non vides (qui se font passer pour vide)
         if self._vide:
-            with open(
-                self._chemin_out
-                / f"{str_nom} {str_date} {str_nom} dossiers -VIDE qui ne le sont pas.csv",
-                "w",
-                newline="",
-                encoding="cp1252",
-            ) as f:
-                w = writer(f, delimiter=";")
-                w.writerow(["chemin"])
-                for path in self._vide:
-                    path_norm = normalize("NFC", str(path))
-                    w.writerow([path_norm])
+            with self._ouvre_csv("dossiers -VIDE qui ne le sont pas") as f:
+                f.write("chemin\r\n")
+                f.write("".join(p + "\r\n" for p in self._echappe_csv(self._vide)))
 
         # Export dossiers vides (qui se font passer pour non vide)
         if self._non_vide:
-            with open(
-                self._chemin_out
-                / f"{str_nom} {str_date} {str_nom} dossiers sans -VIDE qui sont vides.csv",
-                "w",
-                newline="",
-                encoding="cp1252",
-            ) as f:
-                w = writer(f, delimiter=";")
-                w.writerow(["chemin"])
-                for path in self._non_vide:
-                    path_norm = normalize("NFC", str(path))
-                    w.writerow([path_norm])
+            with self._ouvre_csv("dossiers sans -VIDE qui sont vides") as f:
+                f.write("chemin\r\n")
+                f.write("".join(p + "\r\n" for p in self._echappe_csv(self._non_vide)))
 
         # Export fichiers trop longs
         if self._trop_long:
-            with open(
-                self._chemin_out
-                / f"{str_nom} {str_date} {str_nom} fichiers trop longs.csv",
-                "w",
-                newline="",
-                encoding="cp1252",
-            ) as f:
-                w = writer(f, delimiter=";")
-                w.writerow(["chemin"])
-                for path in self._trop_long:
-                    path_norm = normalize("NFC", str(path))
-                    w.writerow([path_norm])
+            with self._ouvre_csv("fichiers trop longs") as f:
+                f.write("chemin\r\n")
+                f.write("".join(p + "\r\n" for p in self._echappe_csv(self._trop_long)))
 
         # Export doublons (hash -> liste des fichiers)
-        if any(len(paths) > 1 for paths in self._hash_map.values()):
-            with open(
-                self._chemin_out
-                / f"{str_nom} {str_date} {str_nom} fichiers doublons.csv",
-                "w",
-                newline="",
-                encoding="cp1252",
-            ) as f:
+        if self._dupliques:
+            with self._ouvre_csv("fichiers doublons") as f:
                 w = writer(f, delimiter=";")
                 w.writerow(["poids total (Ko)", "nb", "chemins"])
-                for _, paths in self._hash_map.items():
-                    if len(paths) > 1:  # doublons seulement
-                        paths_norm = [normalize("NFC", k) for k in paths]
-                        size = getsize(paths[0]) * len(paths)
-                        w.writerow(
-                            [
-                                f"{size/1024:.1f}".replace(".", ","),
-                                len(paths),
-                                *paths_norm,
-                            ]
-                        )
+                w.writerows(
+                    (
+                        f"{self._taille_hash[h] * len(paths) / 1024:.1f}".replace(
+                            ".", ","
+                        ),
+                        len(paths),
+                        *(normalize("NFC", k) for k in paths),
+                    )
+                    for h, paths in self._dupliques.items()
+                )
 
     def main(self):
         """Fonction principale de la classe"""
         # on fait un scan naïf sur le 1er niveau pour jauger du niveau d'avancement
+        dossiers = []
         try:
             for entry in scandir(self._chemin_in):
                 if entry.is_dir(follow_symlinks=False):
-                    logging.info(entry.path)
-                    self._scanne(Path(entry))
+                    dossiers.append(entry.path)
                 elif entry.is_file(follow_symlinks=False):
                     # pas de fichier autorisé au niveau 1
-                    self._mauvais_nom.append((1, entry.path))
+                    self._mauvais_nom.append((1, normalize("NFC", entry.path)))
         except PermissionError:
             logging.critical("pas la permission de scanner %s" % self._chemin_in)
         except FileNotFoundError:
@@ -286,7 +617,11 @@ class Sentinelle:
             logging.critical(
                 "erreur windows, impossible de scanner %s" % self._chemin_in
             )
-        # export des résultats
+        self._scanne(dossiers)
+        # recherche des doublons sur l'ensemble de l'arborescence
+        self._cherche_doublons()
+        # export des résultats, dans un ordre reproductible d'une exécution à l'autre
+        self._trie_resultats()
         self._exporte_csv()
         logging.info("vérification effectuée")
 